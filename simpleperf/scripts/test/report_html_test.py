@@ -15,43 +15,96 @@
 # limitations under the License.
 
 import collections
-import json
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain
+import mmap
 import os
+from pathlib import Path
+import re
+import shutil
 import tempfile
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, Iterator, List, Set, Tuple, Union
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 from binary_cache_builder import BinaryCacheBuilder
+from simpleperf_utils import remove
 from . test_utils import TestBase, TestHelper
 
+# Match the record data json embedded in report.html.
+_JSON_DATA_RE = re.compile(rb'type="application/json"[^>]*>(.*?)</script>', re.DOTALL)
+
+
+class _IntKeyView(Mapping):
+    """ A read-only view of a json object, which accepts int keys. Keys are converted on
+        lookup, instead of rebuilding the whole object up front.
+    """
+
+    def __init__(self, d: Dict[str, Any]):
+        self._d = d
+
+    def __getitem__(self, key: Union[int, str]) -> Any:
+        return self._d[key if isinstance(key, str) else str(key)]
+
+    def __iter__(self) -> Iterator[int]:
+        return map(int, self._d)
+
+    def __len__(self) -> int:
+        return len(self._d)
+
 
 class TestReportHtml(TestBase):
+    # Map from (options, mtimes of input files) to the json extracted from report.html.
+    # It avoids rerunning report_html.py for the same options.
+    _record_data_cache: Dict[Tuple[Tuple[str, ...], Tuple[float, ...]], Future] = {}
+    # Map from perf data path to a binary_cache built for it, shared by tests.
+    _binary_cache_dirs: Dict[str, Path] = {}
+
+    @classmethod
+    def setUpClass(cls):
+        # report_html.py runs in a subprocess, so threads are enough to run several of them
+        # in parallel.
+        cls.executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        cls.testcase_dir = TestHelper.get_test_dir(cls.__name__)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+        cls._record_data_cache.clear()
+        cls._binary_cache_dirs.clear()
+        remove(cls.testcase_dir)
+
     def test_long_callchain(self):
         self.run_cmd(['report_html.py', '-i',
                       TestHelper.testdata_path('perf_with_long_callchain.data')])
 
     def test_aggregated_by_thread_name(self):
+        perf_data = [TestHelper.testdata_path('aggregatable_perf1.data'),
+                     TestHelper.testdata_path('aggregatable_perf2.data')]
         # Calculate event_count for each thread name before aggregation.
-        event_count_for_thread_name = collections.defaultdict(lambda: 0)
         # use "--min_func_percent 0" to avoid cutting any thread.
-        record_data = self.get_record_data(['--min_func_percent', '0', '-i',
-                                            TestHelper.testdata_path('aggregatable_perf1.data'),
-                                            TestHelper.testdata_path('aggregatable_perf2.data')])
+        record_data = self.get_record_data(['--min_func_percent', '0', '-i'] + perf_data)
         event = record_data['sampleInfo'][0]
-        for process in event['processes']:
-            for thread in process['threads']:
-                thread_name = record_data['threadNames'][str(thread['tid'])]
-                event_count_for_thread_name[thread_name] += thread['eventCount']
+        thread_names = record_data['threadNames']
+        event_count_for_thread_name = collections.Counter()
+        for thread_name, event_count in [(thread_names[thread['tid']], thread['eventCount'])
+                                         for process in event['processes']
+                                         for thread in process['threads']]:
+            event_count_for_thread_name[thread_name] += event_count
 
         # Check event count for each thread after aggregation.
-        record_data = self.get_record_data(['--aggregate-by-thread-name',
-                                            '--min_func_percent', '0', '-i',
-                                            TestHelper.testdata_path('aggregatable_perf1.data'),
-                                            TestHelper.testdata_path('aggregatable_perf2.data')])
+        record_data = self.get_record_data(
+            ['--aggregate-by-thread-name', '--min_func_percent', '0', '-i'] + perf_data)
         event = record_data['sampleInfo'][0]
+        thread_names = record_data['threadNames']
         hit_count = 0
         for process in event['processes']:
             for thread in process['threads']:
-                thread_name = record_data['threadNames'][str(thread['tid'])]
+                thread_name = thread_names[thread['tid']]
                 self.assertEqual(thread['eventCount'],
                                  event_count_for_thread_name[thread_name])
                 hit_count += 1
@@ -74,44 +127,77 @@ class TestReportHtml(TestBase):
         """ Test --proguard-mapping-file option. """
         testdata_file = TestHelper.testdata_path('perf_need_proguard_mapping.data')
         proguard_mapping_file = TestHelper.testdata_path('proguard_mapping.txt')
-        original_methodname = 'androidx.fragment.app.FragmentActivity.startActivityForResult'
+        original_methodname = b'androidx.fragment.app.FragmentActivity.startActivityForResult'
         # Can't show original method name without proguard mapping file.
-        record_data = self.get_record_data(['-i', testdata_file])
-        self.assertNotIn(original_methodname, json.dumps(record_data))
+        report = self.get_record_data_bytes(['-i', testdata_file])
+        self.assertNotIn(original_methodname, report)
         # Show original method name with proguard mapping file.
-        record_data = self.get_record_data(
+        report = self.get_record_data_bytes(
             ['-i', testdata_file, '--proguard-mapping-file', proguard_mapping_file])
-        self.assertIn(original_methodname, json.dumps(record_data))
+        self.assertIn(original_methodname, report)
 
     def get_record_data(self, options: List[str]) -> Dict[str, Any]:
-        json_data = self.get_record_data_string(options)
-        return json.loads(json_data)
-
-    def get_record_data_string(self, options: List[str]) -> str:
-        args = ['report_html.py'] + options
-        if TestHelper.ndk_path:
-            args += ['--ndk_path', TestHelper.ndk_path]
-        self.run_cmd(args)
-        with open('report.html', 'r') as fh:
-            data = fh.read()
-        start_str = 'type="application/json"'
-        end_str = '</script>'
-        start_pos = data.find(start_str)
-        self.assertNotEqual(start_pos, -1)
-        start_pos = data.find('>', start_pos)
-        self.assertNotEqual(start_pos, -1)
-        start_pos += 1
-        end_pos = data.find(end_str, start_pos)
-        self.assertNotEqual(end_pos, -1)
-        return data[start_pos:end_pos]
+        record_data = _json.loads(self.get_record_data_bytes(options))
+        # Json object keys are always strings. Wrap threadNames and functionMap, so they can be
+        # looked up directly with tids and function ids in samples.
+        for name in ('threadNames', 'functionMap'):
+            record_data[name] = _IntKeyView(record_data[name])
+        return record_data
+
+    def get_record_data_bytes(self, options: List[str]) -> bytes:
+        """ Return the utf-8 encoded json. Substring checks can run on it without decoding. """
+        return self.submit_record_data(options).result()
+
+    def submit_record_data(self, options: List[str]) -> Future:
+        """ Run report_html.py in the background. Return a future of the json bytes. """
+        key = (tuple(options), tuple(os.path.getmtime(option)
+                                     for option in options if os.path.isfile(option)))
+        future = self._record_data_cache.get(key)
+        if future is None:
+            future = self.executor.submit(self._generate_record_data, options)
+            self._record_data_cache[key] = future
+        return future
+
+    def _generate_record_data(self, options: List[str]) -> bytes:
+        # Write each report to a separate temp dir, so reports generated in parallel don't
+        # overwrite each other, and nothing is left in the test dir.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, 'report.html')
+            args = ['report_html.py'] + options + ['-o', report_path]
+            if TestHelper.ndk_path:
+                args += ['--ndk_path', TestHelper.ndk_path]
+            self.run_cmd(args)
+            return self._extract_record_data(report_path)
+
+    def _extract_record_data(self, report_path: str) -> bytes:
+        # Map report.html instead of reading it, so the OS pages it in on demand and only
+        # the json part is copied out.
+        with open(report_path, 'rb') as fh, \
+                mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            m = _JSON_DATA_RE.search(mm)
+            self.assertIsNotNone(m)
+            return m.group(1)
+
+    def build_binary_cache(self, perf_data: str):
+        """ Build binary_cache in the test dir. Copy it if a previous test has built one for
+            the same perf data.
+        """
+        cache_dir = self._binary_cache_dirs.get(perf_data)
+        if cache_dir:
+            shutil.copytree(cache_dir, 'binary_cache')
+            return
+        binary_cache_builder = BinaryCacheBuilder(TestHelper.ndk_path, False)
+        binary_cache_builder.build_binary_cache(perf_data, [TestHelper.testdata_dir])
+        cache_dir = self.testcase_dir / f'binary_cache_{len(self._binary_cache_dirs)}'
+        shutil.copytree('binary_cache', cache_dir)
+        self._binary_cache_dirs[perf_data] = cache_dir
 
     def test_add_source_code(self):
         """ Test --add_source_code option. """
         testdata_file = TestHelper.testdata_path('runtest_two_functions_arm64_perf.data')
 
         # Build binary_cache.
-        binary_cache_builder = BinaryCacheBuilder(TestHelper.ndk_path, False)
-        binary_cache_builder.build_binary_cache(testdata_file, [TestHelper.testdata_dir])
+        self.build_binary_cache(testdata_file)
 
         # Generate report.html.
         source_dir = TestHelper.testdata_dir
@@ -121,37 +207,30 @@ class TestReportHtml(TestBase):
         # Check source code info in samples.
         source_code_list = []
         thread = record_data['sampleInfo'][0]['processes'][0]['threads'][0]
-        for lib in thread['libs']:
-            for function in lib['functions']:
-                for source_code_info in function.get('s') or []:
-                    source_file = record_data['sourceFiles'][source_code_info['f']]
-                    file_path = source_file['path']
-                    line_number = source_code_info['l']
-                    line_content = source_file['code'][str(line_number)]
-                    event_count = source_code_info['e']
-                    subtree_event_count = source_code_info['s']
-                    s = (f'{file_path}:{line_number}:{line_content}:' +
-                         f'{event_count}:{subtree_event_count}')
-                    source_code_list.append(s)
+        source_files = record_data['sourceFiles']
+        for function in chain.from_iterable(lib['functions'] for lib in thread['libs']):
+            for source_code_info in function.get('s') or []:
+                source_file = source_files[source_code_info['f']]
+                file_path = source_file['path']
+                line_number = source_code_info['l']
+                line_content = source_file['code'][str(line_number)]
+                event_count = source_code_info['e']
+                subtree_event_count = source_code_info['s']
+                s = (f'{file_path}:{line_number}:{line_content}:' +
+                     f'{event_count}:{subtree_event_count}')
+                source_code_list.append(s)
         check_items = ['two_functions.cpp:9:    *p = i;\n:590184:590184',
                        'two_functions.cpp:16:    *p = i;\n:591577:591577',
                        'two_functions.cpp:22:    Function1();\n:0:590184',
                        'two_functions.cpp:23:    Function2();\n:0:591577']
-        for item in check_items:
-            found = False
-            for source_code in source_code_list:
-                if item in source_code:
-                    found = True
-                    break
-            self.assertTrue(found, item)
+        self.check_strings_in_content('\n'.join(source_code_list), check_items)
 
     def test_add_disassembly(self):
         """ Test --add_disassembly option. """
         testdata_file = TestHelper.testdata_path('runtest_two_functions_arm64_perf.data')
 
         # Build binary_cache.
-        binary_cache_builder = BinaryCacheBuilder(TestHelper.ndk_path, False)
-        binary_cache_builder.build_binary_cache(testdata_file, [TestHelper.testdata_dir])
+        self.build_binary_cache(testdata_file)
 
         # Generate report.html.
         record_data = self.get_record_data(['-i', testdata_file, '--add_disassembly'])
@@ -159,32 +238,28 @@ class TestReportHtml(TestBase):
         # Check disassembly in samples.
         disassembly_list = []
         thread = record_data['sampleInfo'][0]['processes'][0]['threads'][0]
+        lib_list = record_data['libList']
+        function_map = record_data['functionMap']
         for lib in thread['libs']:
-            lib_name = record_data['libList'][lib['libId']]
+            lib_name = lib_list[lib['libId']]
             for function in lib['functions']:
+                function_data = function_map[function['f']]
+                function_name = function_data['f']
+                dis_addrs = {dis_addr for _, dis_addr in function_data.get('d') or []}
                 for addr_info in function.get('a') or []:
                     addr = addr_info['a']
-                    event_count = addr_info['e']
-                    subtree_event_count = addr_info['s']
-                    function_data = record_data['functionMap'][str(function['f'])]
-                    function_name = function_data['f']
-                    for dis_line, dis_addr in function_data.get('d') or []:
-                        if addr == dis_addr:
-                            s = (f'{lib_name}:{function_name}:{addr}:' +
-                                 f'{event_count}:{subtree_event_count}')
-                            disassembly_list.append(s)
+                    if addr in dis_addrs:
+                        event_count = addr_info['e']
+                        subtree_event_count = addr_info['s']
+                        s = (f'{lib_name}:{function_name}:{addr}:' +
+                             f'{event_count}:{subtree_event_count}')
+                        disassembly_list.append(s)
 
         check_items = ['simpleperf_runtest_two_functions_arm64:Function1():0x1094:590184:590184',
                        'simpleperf_runtest_two_functions_arm64:Function2():0x1104:591577:591577',
                        'simpleperf_runtest_two_functions_arm64:main:0x113c:0:590184',
                        'simpleperf_runtest_two_functions_arm64:main:0x1140:0:591577']
-        for item in check_items:
-            found = False
-            for disassembly in disassembly_list:
-                if item in disassembly:
-                    found = True
-                    break
-            self.assertTrue(found, item)
+        self.check_strings_in_content('\n'.join(disassembly_list), check_items)
 
     def test_trace_offcpu(self):
         """ Test --trace-offcpu option. """
@@ -213,44 +288,57 @@ class TestReportHtml(TestBase):
         self.assertEqual(record_data['sampleInfo'][0]['eventCount'], 396124304)
 
     def test_sample_filters(self):
+        perf_data = TestHelper.testdata_path('perf_display_bitmaps.data')
+
+        def get_options(filter: str) -> List[str]:
+            return ['-i', perf_data] + filter.split()
+
         def get_threads_for_filter(filter: str) -> Set[int]:
-            record_data = self.get_record_data(
-                ['-i', TestHelper.testdata_path('perf_display_bitmaps.data')] + filter.split())
-            threads = set()
-            try:
-                for thread in record_data['sampleInfo'][0]['processes'][0]['threads']:
-                    threads.add(thread['tid'])
-            except IndexError:
-                pass
-            return threads
-
-        self.assertNotIn(31850, get_threads_for_filter('--exclude-pid 31850'))
-        self.assertIn(31850, get_threads_for_filter('--include-pid 31850'))
-        self.assertIn(31850, get_threads_for_filter('--pid 31850'))
-        self.assertNotIn(31881, get_threads_for_filter('--exclude-tid 31881'))
-        self.assertIn(31881, get_threads_for_filter('--include-tid 31881'))
-        self.assertIn(31881, get_threads_for_filter('--tid 31881'))
-        self.assertNotIn(31881, get_threads_for_filter(
-            '--exclude-process-name com.example.android.displayingbitmaps'))
-        self.assertIn(31881, get_threads_for_filter(
-            '--include-process-name com.example.android.displayingbitmaps'))
-        self.assertNotIn(31850, get_threads_for_filter(
-            '--exclude-thread-name com.example.android.displayingbitmaps'))
-        self.assertIn(31850, get_threads_for_filter(
-            '--include-thread-name com.example.android.displayingbitmaps'))
-
-        with tempfile.NamedTemporaryFile('w', delete=False) as filter_file:
-            filter_file.write('GLOBAL_BEGIN 684943449406175\nGLOBAL_END 684943449406176')
-            filter_file.flush()
-            threads = get_threads_for_filter('--filter-file ' + filter_file.name)
-            self.assertIn(31881, threads)
-            self.assertNotIn(31850, threads)
-        os.unlink(filter_file.name)
+            record_data = self.get_record_data(get_options(filter))
+            # A filter can remove all samples or all processes.
+            sample_info = record_data['sampleInfo']
+            processes = sample_info[0]['processes'] if sample_info else []
+            return {thread['tid'] for thread in processes[0]['threads']} if processes else set()
+
+        # Put the filter file in tmpfs when available. Use a temp dir instead of a
+        # NamedTemporaryFile, because on Windows an opened temp file can't be read by
+        # report_html.py.
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.TemporaryDirectory(dir=shm_dir) as tmp_dir:
+            filter_file = os.path.join(tmp_dir, 'sample.filter')
+            with open(filter_file, 'w') as fh:
+                fh.write('GLOBAL_BEGIN 684943449406175\nGLOBAL_END 684943449406176')
+
+            # (filter, tid, whether the tid is expected in the report)
+            checks = [
+                ('--exclude-pid 31850', 31850, False),
+                ('--include-pid 31850', 31850, True),
+                ('--pid 31850', 31850, True),
+                ('--exclude-tid 31881', 31881, False),
+                ('--include-tid 31881', 31881, True),
+                ('--tid 31881', 31881, True),
+                ('--exclude-process-name com.example.android.displayingbitmaps', 31881, False),
+                ('--include-process-name com.example.android.displayingbitmaps', 31881, True),
+                ('--exclude-thread-name com.example.android.displayingbitmaps', 31850, False),
+                ('--include-thread-name com.example.android.displayingbitmaps', 31850, True),
+                ('--filter-file ' + filter_file, 31881, True),
+                ('--filter-file ' + filter_file, 31850, False),
+            ]
+            # All reports use the same input, so generate them in parallel before checking.
+            for filter, _, _ in checks:
+                self.submit_record_data(get_options(filter))
+
+            for filter, tid, expected in checks:
+                threads = get_threads_for_filter(filter)
+                if expected:
+                    self.assertIn(tid, threads, filter)
+                else:
+                    self.assertNotIn(tid, threads, filter)
 
     def test_show_art_frames(self):
-        art_frame_str = 'art::interpreter::DoCall'
+        art_frame_str = b'art::interpreter::DoCall'
         options = ['-i', TestHelper.testdata_path('perf_with_interpreter_frames.data')]
-        report = self.get_record_data_string(options)
+        report = self.get_record_data_bytes(options)
         self.assertNotIn(art_frame_str, report)
-        report = self.get_record_data_string(options + ['--show-art-frames'])
+        report = self.get_record_data_bytes(options + ['--show-art-frames'])
         self.assertIn(art_frame_str, report)